@@ -1,38 +1,65 @@
+import os
+import re
 import sys
+import mmap
 import asyncio
-import subprocess
 from base64 import b64encode
 from datetime import datetime
 from pathlib import Path
 from os import environ
 
+from anthropic import NOT_GIVEN, AsyncAnthropic, DefaultAsyncHttpxClient
 from think.llm import LLM
+from think.llm.anthropic import AnthropicAdapter
 from think.llm.chat import Chat, ContentPart, ContentType, Message, Role
 from think.llm.tool import ToolKit, ToolError, ToolResponse
 
 
 # --- Multimodal support ---
 
-IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp"}
-DOCUMENT_EXTENSIONS = {".pdf"}
-
-MIME_TYPES = {
-    ".png": "image/png",
-    ".jpg": "image/jpeg",
-    ".jpeg": "image/jpeg",
-    ".gif": "image/gif",
-    ".webp": "image/webp",
-    ".pdf": "application/pdf",
+# Suffix -> (kind, MIME type) for files that are attached, not read as text
+FILE_TYPES = {
+    ".png": ("image", "image/png"),
+    ".jpg": ("image", "image/jpeg"),
+    ".jpeg": ("image", "image/jpeg"),
+    ".gif": ("image", "image/gif"),
+    ".webp": ("image", "image/webp"),
+    ".pdf": ("document", "application/pdf"),
 }
 
 _pending_images: list[str] = []
 _pending_documents: list[str] = []
 
+# (path, mtime, size) of files already attached to the conversation
+_attached_files: set[tuple[Path, int, int]] = set()
+
+
+# Multiple of 3, so each chunk encodes to base64 without padding
+ENCODE_CHUNK_SIZE = 3 * 256 * 1024
+
+
+def _file_type(path: Path) -> tuple[str, str] | None:
+    # Suffixes are usually lowercase already, so try that first
+    suffix = path.suffix
+    return FILE_TYPES.get(suffix) or FILE_TYPES.get(suffix.lower())
+
 
 def _to_data_url(path: Path) -> str:
-    data = b64encode(path.read_bytes()).decode("ascii")
-    mime = MIME_TYPES[path.suffix.lower()]
-    return f"data:{mime};base64,{data}"
+    _, mime = _file_type(path)
+    parts = [f"data:{mime};base64,"]
+    with open(path, "rb") as f:
+        while chunk := f.read(ENCODE_CHUNK_SIZE):
+            parts.append(b64encode(chunk).decode("ascii"))
+    return "".join(parts)
+
+
+def _already_attached(path: Path) -> bool:
+    st = path.stat()
+    key = (path.resolve(), st.st_mtime_ns, st.st_size)
+    if key in _attached_files:
+        return True
+    _attached_files.add(key)
+    return False
 
 
 # --- Tools ---
@@ -45,14 +72,19 @@ def read_file(path: str) -> str:
     :return: The file contents or a confirmation that the file was loaded
     """
     p = Path(path)
-    ext = p.suffix.lower()
-    if ext in IMAGE_EXTENSIONS:
+    file_type = _file_type(p)
+    if file_type is None:
+        return p.read_text()
+
+    # The model still sees files attached earlier in the conversation,
+    # so don't send the same version of a file again.
+    if _already_attached(p):
+        return f"Already loaded earlier in the conversation: {path}"
+    if file_type[0] == "image":
         _pending_images.append(_to_data_url(p))
         return f"Image loaded: {path}"
-    if ext in DOCUMENT_EXTENSIONS:
-        _pending_documents.append(_to_data_url(p))
-        return f"Document loaded: {path}"
-    return p.read_text()
+    _pending_documents.append(_to_data_url(p))
+    return f"Document loaded: {path}"
 
 
 def write_file(path: str, content: str) -> str:
@@ -74,27 +106,122 @@ def update_file(path: str, old: str, new: str) -> str:
     :param new: The replacement string
     :return: Confirmation message
     """
-    text = Path(path).read_text()
-    if old not in text:
-        raise ToolError(f"String not found in {path}")
-    Path(path).write_text(text.replace(old, new, 1))
+    old_b = old.encode()
+    new_b = new.encode()
+
+    with open(path, "r+b") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # mmap can't map an empty file
+            if old_b:
+                raise ToolError(f"String not found in {path}")
+            f.write(new_b)
+            return f"Updated {path}"
+
+        with mmap.mmap(f.fileno(), 0) as mm:
+            idx = mm.find(old_b)
+            if idx == -1 and b"\n" in old_b and mm.find(b"\r\n") != -1:
+                # read_file shows CRLF files with LF line endings, so match
+                # (and keep) the file's own line endings
+                old_b = old_b.replace(b"\n", b"\r\n")
+                new_b = new_b.replace(b"\n", b"\r\n")
+                idx = mm.find(old_b)
+            if idx == -1:
+                raise ToolError(f"String not found in {path}")
+
+            if len(new_b) == len(old_b):
+                mm[idx : idx + len(old_b)] = new_b
+                mm.flush()
+                return f"Updated {path}"
+
+            tail = mm[idx + len(old_b) :]
+
+        # Rewrite the file from the edit onwards, in place, so that the
+        # inode (and with it hard links, ownership and xattrs) is kept
+        f.seek(idx)
+        f.write(new_b)
+        f.write(tail)
+        f.truncate()
+
     return f"Updated {path}"
 
 
-def bash(command: str) -> str:
+BASH_TIMEOUT = 120
+
+# Plain `cp src dst` or `mv src dst` without flags or shell syntax
+SIMPLE_COPY = re.compile(r"(cp|mv) +([\w./][\w./-]*) +([\w./][\w./-]*)")
+
+
+def _copy_or_move(command: str) -> bool:
+    """Run a simple cp or mv in-process instead of spawning a shell.
+
+    Returns False if the command isn't a simple copy or move of a regular
+    file, or if it fails, in which case the shell should run it instead
+    (and report any errors).
+    """
+    m = SIMPLE_COPY.fullmatch(command.strip())
+    if not m:
+        return False
+    op, src, dst = m[1], Path(m[2]), Path(m[3])
+    if not src.is_file():
+        return False
+    # Leave anything but an existing directory or a plain file path (eg.
+    # "missing/", which Path would turn into "missing") to the shell
+    if dst.is_dir():
+        dst = dst / src.name
+    elif m[3].endswith("/") or (dst.exists() and not dst.is_file()):
+        return False
+
+    try:
+        if dst.exists() and dst.samefile(src):
+            return False
+        if op == "mv":
+            os.rename(src, dst)
+            return True
+
+        with open(src, "rb") as fsrc:
+            st = os.fstat(fsrc.fileno())
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+            fd = os.open(dst, flags, st.st_mode & 0o777)
+            with open(fd, "wb") as fdst:
+                offset = 0
+                while offset < st.st_size:
+                    sent = os.sendfile(fd, fsrc.fileno(), offset, st.st_size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+    except OSError:
+        return False
+    return True
+
+
+async def bash(command: str) -> str:
     """Execute a shell command and return its output.
 
     :param command: The shell command to execute
     :return: Combined stdout and stderr output
     """
-    result = subprocess.run(
-        command, shell=True, capture_output=True, text=True, timeout=120
+    if await asyncio.to_thread(_copy_or_move, command):
+        return "(no output)"
+
+    proc = await asyncio.create_subprocess_shell(
+        command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
     )
-    output = result.stdout
-    if result.stderr:
-        output += result.stderr
-    if result.returncode != 0:
-        output += f"\n(exit code: {result.returncode})"
+    try:
+        stdout, stderr = await asyncio.wait_for(
+            proc.communicate(), timeout=BASH_TIMEOUT
+        )
+    except TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise ToolError(f"Command timed out after {BASH_TIMEOUT} seconds")
+
+    output = stdout.decode(errors="replace")
+    if stderr:
+        output += stderr.decode(errors="replace")
+    if proc.returncode != 0:
+        output += f"\n(exit code: {proc.returncode})"
     return output or "(no output)"
 
 
@@ -105,7 +232,10 @@ def ask(prompt: str) -> str:
     :return: The user's response as a string
     """
     print(f"\n[QUESTION]: {prompt}")
-    response = input("   > ").strip()
+    try:
+        response = input("   > ").strip()
+    except EOFError:
+        raise ToolError("The user is not available to answer questions")
     return response
 
 
@@ -128,18 +258,123 @@ def display_tool_call(name, args):
             print(f"  {k}: {s}")
 
 
+def _answer(prompt):
+    try:
+        return input(prompt).strip().lower()
+    except EOFError:
+        # No one to ask (eg. the prompt was piped in), so deny
+        print()
+        return "n"
+
+
 def confirm_tool(name, args):
-    display_tool_call(name, args)
     if name not in CONFIRM_TOOLS:
         return True
-    answer = input("  Allow? [Y/n] ").strip().lower()
-    return answer in ("", "y", "yes")
+    display_tool_call(name, args)
+    return _answer("  Allow? [Y/n] ") in ("", "y", "yes")
+
+
+def batch_confirm(tool_calls):
+    """Confirm a batch of tool calls with a single prompt.
+
+    All calls needing confirmation are shown together, and the user can
+    allow or deny them all at once, or review them one by one.
+
+    :return: List of approvals, one per tool call
+    """
+    to_confirm = [tc for tc in tool_calls if tc.name in CONFIRM_TOOLS]
+    if len(to_confirm) < 2:
+        approved = [confirm_tool(tc.name, tc.arguments) for tc in tool_calls]
+        if not all(approved):
+            print("  DENIED")
+        return approved
+
+    for tc in to_confirm:
+        display_tool_call(tc.name, tc.arguments)
+    answer = _answer(f"  Allow all {len(to_confirm)} calls? [Y/n/r] ")
+    if answer in ("", "y", "yes"):
+        return [True] * len(tool_calls)
+    if answer not in ("r", "review"):
+        print("  DENIED")
+        return [tc.name not in CONFIRM_TOOLS for tc in tool_calls]
+
+    # The calls are already shown above, so only prompt for each one
+    approved = []
+    n = 0
+    for tc in tool_calls:
+        if tc.name not in CONFIRM_TOOLS:
+            approved.append(True)
+            continue
+        n += 1
+        prompt = f"  Allow {tc.name} ({n} of {len(to_confirm)})? [Y/n] "
+        ok = _answer(prompt) in ("", "y", "yes")
+        if not ok:
+            print("  DENIED")
+        approved.append(ok)
+    return approved
 
 
 # --- Agent loop ---
 
 MAX_STEPS = 20
 MAX_TOKENS = 16384
+# Total size of tool outputs kept in the chat history, in characters
+MAX_TOOL_OUTPUT = 100_000
+ELIDED_PREFIX = "[elided: "
+
+
+def elide_tool_outputs(chat):
+    """Replace the oldest tool outputs with stubs to bound the history size.
+
+    Tool responses keep their call so that tool call/response pairing
+    stays valid. Outputs from the most recent tool message are kept.
+    Messages with elided outputs are replaced rather than modified, so
+    existing Message objects never change once in the chat.
+    """
+    total = sum(
+        len(part.tool_response.response)
+        for msg in chat.messages
+        if msg.role == Role.tool
+        for part in msg.content
+        if part.type == ContentType.tool_response and part.tool_response.response
+    )
+
+    for i, msg in enumerate(chat.messages[:-1]):
+        if total <= MAX_TOOL_OUTPUT:
+            break
+        if msg.role != Role.tool:
+            continue
+
+        content = []
+        changed = False
+        for part in msg.content:
+            tr = part.tool_response
+            if (
+                total > MAX_TOOL_OUTPUT
+                and part.type == ContentType.tool_response
+                and tr.response
+                and not tr.response.startswith(ELIDED_PREFIX)
+            ):
+                size = len(tr.response)
+                stub = f"{ELIDED_PREFIX}{size} characters of earlier output]"
+                if len(stub) < size:
+                    total -= size - len(stub)
+                    part = ContentPart(
+                        type=ContentType.tool_response,
+                        tool_response=ToolResponse(call=tr.call, response=stub),
+                    )
+                    changed = True
+            content.append(part)
+
+        if changed:
+            chat.messages[i] = Message(role=msg.role, content=content)
+
+
+DENIED = "User denied this action."
+
+
+async def _denied(tc):
+    return ToolResponse(call=tc, error=DENIED)
 
 
 async def run(llm, chat, toolkit):
@@ -151,37 +386,58 @@ async def run(llm, chat, toolkit):
         )
         chat.messages.append(message)
 
-        text_parts = []
+        has_text = False
         tool_calls = []
         for part in message.content:
             if part.type == ContentType.text and part.text:
-                text_parts.append(part.text)
+                if not has_text:
+                    sys.stdout.write("\n")
+                    has_text = True
+                sys.stdout.write(part.text)
             elif part.type == ContentType.tool_call:
                 tool_calls.append(part.tool_call)
 
-        if text_parts:
-            print("\n" + "".join(text_parts))
+        if has_text:
+            sys.stdout.write("\n")
 
         if not tool_calls:
             break
 
-        responses = []
-        for tc in tool_calls:
-            if confirm_tool(tc.name, tc.arguments):
-                tr = await toolkit.execute_tool_call(tc)
-                if tr.error:
-                    print(f"  ERROR: {tr.error}")
-                else:
-                    preview = (
-                        tr.response
-                        if len(tr.response) <= 500
-                        else tr.response[:500] + "…"
-                    )
-                    print(f"  -> {preview}")
+        # Confirmation needs user input so it happens up front. Calls in
+        # one message may depend on earlier ones, so if any approved call
+        # can change state (CONFIRM_TOOLS), all of them run one at a time,
+        # in order. Only batches of read-only calls run concurrently.
+        calls = list(zip(tool_calls, batch_confirm(tool_calls)))
+        if any(ok and tc.name in CONFIRM_TOOLS for tc, ok in calls):
+            responses = [
+                await toolkit.execute_tool_call(tc) if ok else await _denied(tc)
+                for tc, ok in calls
+            ]
+        else:
+            responses = await asyncio.gather(
+                *(
+                    toolkit.execute_tool_call(tc) if ok else _denied(tc)
+                    for tc, ok in calls
+                ),
+                return_exceptions=True,
+            )
+        for tr in responses:
+            if isinstance(tr, BaseException):
+                raise tr
+            name = tr.call.name
+            if tr.error == DENIED:
+                continue
+            if name not in CONFIRM_TOOLS:
+                display_tool_call(name, tr.call.arguments)
+            if tr.error:
+                print(f"  {name} ERROR: {tr.error}")
             else:
-                tr = ToolResponse(call=tc, error="User denied this action.")
-                print("  DENIED")
-            responses.append(tr)
+                preview = (
+                    tr.response
+                    if len(tr.response) <= 500
+                    else tr.response[:500] + "…"
+                )
+                print(f"  {name} -> {preview}")
 
         chat.messages.append(
             Message(
@@ -192,6 +448,7 @@ async def run(llm, chat, toolkit):
                 ],
             )
         )
+        elide_tool_outputs(chat)
 
         if _pending_images or _pending_documents:
             chat.messages.append(
@@ -207,17 +464,111 @@ async def run(llm, chat, toolkit):
         print("\n(max steps reached)")
 
 
+def connect(url, http_client):
+    """Create an LLM client, reusing the shared HTTP connection pool.
+
+    For providers other than Anthropic, the client is left as created by
+    think, with its own connections.
+    """
+    llm = LLM.from_url(url)
+    if llm.provider == "anthropic":
+        llm.client = AsyncAnthropic(
+            api_key=llm.api_key, base_url=llm.base_url, http_client=http_client
+        )
+    return llm
+
+
+class CachingAnthropicAdapter(AnthropicAdapter):
+    """Anthropic adapter that caches the system prompt and converted messages.
+
+    The system message is expected to consist of a stable part (the agent
+    prompt) followed by volatile context (environment, recent memory).
+    Only the first part is marked with `cache_control`, so the cached
+    prefix stays the same across turns and invocations.
+
+    Messages are never modified once added to the chat (only appended or
+    replaced), so each is converted to the API format once and reused on
+    later turns.
+    """
+
+    def __init__(self, toolkit=None):
+        super().__init__(toolkit)
+        self._dumped: list[tuple[Message, dict]] = []
+
+    def dump_chat(self, chat):
+        messages = chat.messages
+        system = NOT_GIVEN
+        if len(messages) > 1 and messages[0].role == Role.system:
+            system = [
+                {"type": "text", "text": part.text.strip()}
+                for part in messages[0].content
+                if part.type == ContentType.text and part.text.strip()
+            ]
+            # With no agent prompt, only the volatile context is left
+            if len(system) > 1:
+                system[0]["cache_control"] = {"type": "ephemeral"}
+            messages = messages[1:]
+
+        dumped = []
+        for i, msg in enumerate(messages):
+            if i < len(self._dumped) and self._dumped[i][0] is msg:
+                dumped.append(self._dumped[i][1])
+            else:
+                dumped.append(self.dump_message(msg))
+        self._dumped = list(zip(messages, dumped))
+        return system, dumped
+
+
 MEMORY_FILE = Path("MEMORY.md")
+MEMORY_CHUNK_SIZE = 8192
+MEMORY_TIMEOUT = 30
 
 
 def load_recent_memory(n=3):
     if not MEMORY_FILE.exists():
         return ""
-    text = MEMORY_FILE.read_text().strip()
-    if not text:
+
+    # The memory log only grows, so read it backwards from the end until
+    # we have enough complete entries.
+    entries = []  # newest first
+    front = []  # bytes before the earliest separator seen, in reverse order
+    front_dashes = 0  # length of the run of dashes that front starts with
+    with open(MEMORY_FILE, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        while pos > 0 and len(entries) < n:
+            step = min(MEMORY_CHUNK_SIZE, pos)
+            pos -= step
+            f.seek(pos)
+            chunk = f.read(step)
+            lead = len(chunk) - len(chunk.lstrip(b"-"))
+            # Don't split inside a run of dashes that may continue in the
+            # previous chunk, so separators match a split of the whole file
+            skip = lead if pos > 0 else 0
+
+            # front holds no separator except in its leading dashes, so
+            # one can only be in the chunk or where the chunk meets them
+            rest = chunk[skip:]
+            trailing = len(rest) - len(rest.rstrip(b"-"))
+            if not rest or (b"---" not in rest and trailing + front_dashes < 3):
+                front.append(chunk)
+                front_dashes = lead + front_dashes if lead == len(chunk) else lead
+                continue
+
+            data = chunk + b"".join(reversed(front))
+            pieces = data[skip:].split(b"---")
+            # The first piece may be cut off mid-entry
+            front = [data[:skip] + pieces[0]]
+            front_dashes = skip
+            entries.extend(e.strip() for e in reversed(pieces[1:]) if e.strip())
+
+    if pos == 0:
+        first = b"".join(reversed(front)).strip()
+        if first:
+            entries.append(first)
+
+    recent = [e.decode() for e in reversed(entries[:n])]
+    if not recent:
         return ""
-    entries = [e.strip() for e in text.split("---") if e.strip()]
-    recent = entries[-n:]
     return "---\n" + "\n---\n".join(recent) + "\n---"
 
 
@@ -239,22 +590,31 @@ Rules:
 - Output ONLY the entry/entries, nothing else"""
 
 
-async def save_memory(chat, timestamp):
+async def save_memory(chat, timestamp, http_client):
     memory_url = environ.get(
         "MEMORY_LLM_URL", "anthropic:///claude-haiku-4-5-20251001"
     )
-    memory_llm = LLM.from_url(memory_url)
+    memory_llm = connect(memory_url, http_client)
 
     summary_chat = chat.clone()
     summary_chat.user(MEMORY_PROMPT.format(timestamp=timestamp))
     entry = await memory_llm(summary_chat)
 
-    with open(MEMORY_FILE, "a") as f:
-        if MEMORY_FILE.stat().st_size > 0 and not entry.startswith("\n"):
-            f.write("\n")
-        f.write(entry)
-        if not entry.endswith("\n"):
-            f.write("\n")
+    await asyncio.to_thread(append_memory, entry)
+
+
+def append_memory(entry):
+    data = entry.encode()
+    if not data.endswith(b"\n"):
+        data += b"\n"
+
+    fd = os.open(MEMORY_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size > 0 and not data.startswith(b"\n"):
+            data = b"\n" + data
+        os.write(fd, data)
+    finally:
+        os.close(fd)
 
 
 AGENT_TEMPLATE = """# Agent
@@ -293,39 +653,68 @@ See [CLI-TOOLS.md](CLI-TOOLS.md) for a list of useful command-line tools availab
 
 
 async def main():
-    if len(sys.argv) < 2:
-        print("Usage: paw <prompt>")
-        sys.exit(1)
+    if len(sys.argv) == 2:
+        prompt = sys.argv[1]
+    elif len(sys.argv) > 2:
+        prompt = " ".join(sys.argv[1:])
+    elif not sys.stdin.isatty():
+        prompt = sys.stdin.read().strip()
+    else:
+        prompt = ""
 
-    prompt = " ".join(sys.argv[1:])
+    if not prompt:
+        print("Usage: paw <prompt>  (or pipe the prompt via stdin)")
+        sys.exit(1)
 
     agent_md = Path("AGENT.md")
     if not agent_md.exists():
         agent_md.write_text(AGENT_TEMPLATE)
     system = agent_md.read_text()
 
+    # Volatile context goes last, after the cacheable agent prompt
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     cwd = Path.cwd().resolve()
-    system += f"\n\n## Environment\n\n- Working directory: {cwd}\n- Date/time: {now}"
+    context = f"## Environment\n\n- Working directory: {cwd}\n- Date/time: {now}"
 
     recent_memory = load_recent_memory()
     if recent_memory:
-        system += f"\n\n## Recent Memory\n\n{recent_memory}"
-
-    llm_url = environ.get("LLM_URL", "anthropic:///claude-sonnet-4-5-20250929")
-    llm = LLM.from_url(llm_url)
+        context += f"\n\n## Recent Memory\n\n{recent_memory}"
 
     toolkit = ToolKit([read_file, write_file, update_file, bash, ask])
-    chat = Chat(system)
+    # Separate the parts for providers that join them without a separator
+    if system:
+        context = "\n\n" + context
+    chat = Chat()
+    chat.messages.append(
+        Message(
+            role=Role.system,
+            content=[
+                ContentPart(type=ContentType.text, text=text)
+                for text in (system, context)
+                if text
+            ],
+        )
+    )
     chat.user(prompt)
 
-    await run(llm, chat, toolkit)
+    # Share one connection pool between the agent and the memory LLM
+    async with DefaultAsyncHttpxClient() as http_client:
+        llm_url = environ.get("LLM_URL", "anthropic:///claude-sonnet-4-5-20250929")
+        llm = connect(llm_url, http_client)
+        if llm.adapter_class is AnthropicAdapter:
+            llm.adapter_class = CachingAnthropicAdapter
 
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    try:
-        await save_memory(chat, timestamp)
-    except Exception as e:
-        print(f"\n(failed to save memory: {e})")
+        await run(llm, chat, toolkit)
+
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            await asyncio.wait_for(
+                save_memory(chat, timestamp, http_client), MEMORY_TIMEOUT
+            )
+        except TimeoutError:
+            print("\n(timed out saving memory)")
+        except Exception as e:
+            print(f"\n(failed to save memory: {e})")
 
 
 def main_sync():